@@ -1,4 +1,12 @@
 
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+import requests
+import warnings
+
+from utils import requests_retry_session, parse_json, cached, RateLimiter
+
+
 class AlphaVantage:
     """
         AplaVantage class to make simple requests to AlphaVantage API
@@ -7,13 +15,18 @@ class AlphaVantage:
         -------
         api_key
             key retrieved from AlphaVantage portal to authenticate the client request
+        requests_per_minute: int or None, default = 5
+            AlphaVantage rate limit, applied to the requests actually sent (cache hits are free).
+            None disables the throttle (premium keys)
     """
     
-    def __init__(self, api_key):
+    def __init__(self, api_key, requests_per_minute=5):
         
         self.api_key = api_key
-        self.session = requests_retry_session()
+        self.session = requests_retry_session(shared=True)
+        self.rate_limiter = RateLimiter(requests_per_minute) if requests_per_minute else None
         
+    @cached(endpoint='sma', ttl=lambda params: 60 if params['interval'].endswith('min') else 3600 * 12)
     def get_sma(self, ticker, interval, time_period, series_type):
         """
         Get simple moving average for a given ticker
@@ -29,22 +42,84 @@ class AlphaVantage:
             number of data points used to calculate each moving average value (ex. '200', '20')
         series_type: str
             the desired price type in the time series (ex. 'open', 'close')
+        bypass_cache: bool, default = False
+            if True, ignore the on-disk cache and request the series again
         
         Returns
         -------
         resp: dict
             dict containing the sma time series in a default range
+
+        Raises
+        ------
+        ValueError
+            if AlphaVantage answers with an error or rate limit note instead of the series
         """
         
-        serv_url = 'https://www.alphavantage.co/query?'
-        endpoint = 'function=SMA'
+        # only reached on a cache miss, so cached series do not count against the rate limit
+        if self.rate_limiter is not None:
+            self.rate_limiter.wait()
         
-        resp = self.session.get(
-            serv_url
-            + endpoint
-            + f'&symbol={ticker}&interval={interval}&time_period={time_period}&series_type={series_type}&apikey={self.api_key}'
-        ).json()
+        resp = self.session.get(self._sma_url(ticker, interval, time_period, series_type))
+        resp.raise_for_status()
+        resp = parse_json(resp)
+        
+        # errors and rate limit notes come back with a 200 status
+        if 'Technical Analysis: SMA' not in resp:
+            raise ValueError(
+                resp.get('Error Message') or resp.get('Note') or resp.get('Information') or str(resp)
+            )
         
         return resp['Technical Analysis: SMA']
     
-
+    def get_sma_batch(self, tickers, interval, time_period, series_type, max_workers=8):
+        """
+        Get simple moving averages for several tickers, fetched concurrently through get_sma()
+        (and so its on-disk cache). A ticker whose request fails is reported with a warning 
+        and left out of the result, the other tickers are still returned
+        
+        Parameters
+        ----------
+        tickers: list(str)
+            the tickers for which to find the sma time series (ex. ['AAPL', 'MSFT'])
+        interval: str
+            time interval between two consecutive data points in the time series(ex. '1min', 'daily')
+        time_period: str
+            number of data points used to calculate each moving average value (ex. '200', '20')
+        series_type: str
+            the desired price type in the time series (ex. 'open', 'close')
+        max_workers: int, default = 8
+            number of threads used to send the requests, throttled by the instance rate limit
+        
+        Returns
+        -------
+        dict
+            dict mapping each successful ticker to its sma time series, as returned by get_sma()
+        """
+        
+        def fetch(ticker):
+            try:
+                return self.get_sma(ticker, interval, time_period, series_type), None
+            except (ValueError, requests.RequestException) as e:
+                return None, e
+        
+        results = {}
+        with ThreadPoolExecutor(max_workers) as ex:
+            for ticker, (sma, error) in zip(tickers, ex.map(fetch, tickers)):
+                if error is None:
+                    results[ticker] = sma
+                else:
+                    warnings.warn(f'SMA request failed for {ticker}: {error}')
+        
+        return results
+    
+    def _sma_url(self, ticker, interval, time_period, series_type):
+        
+        return 'https://www.alphavantage.co/query?' + urlencode({
+            'function': 'SMA',
+            'symbol': ticker,
+            'interval': interval,
+            'time_period': time_period,
+            'series_type': series_type,
+            'apikey': self.api_key
+        })
@@ -1,6 +1,40 @@
 
-from utils import requests_retry_session
-import os
+from utils import requests_retry_session, httpx_retry_client, parse_json, cached, make_candles_df, CANDLE_COLUMNS
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from urllib.parse import urlencode
+import asyncio
+import contextlib
+import requests
+import threading
+import time
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+def _token_url(refresh_token):
+    
+    return 'https://login.questrade.com/oauth2/token?' + urlencode(
+        {'grant_type': 'refresh_token', 'refresh_token': refresh_token}
+    )
+
+
+def _candles_ttl(params):
+    
+    # candles of a closed window never change, the current day is still being filled
+    if params['end_time'] >= date.today().strftime('%Y-%m-%d'):
+        return 60
+    
+    return 86400 * 30
+
 
 class Questrade:
     """
@@ -10,15 +44,31 @@ class Questrade:
         -------
         client_token
             token retrieved from Questrade portal to authenticate the client application
+        http2: bool, default = False
+            if True, send the requests through an HTTP/2 httpx client, which multiplexes 
+            the concurrent calls of get_quote_batch over a single connection
+
+        The async methods share an aiohttp session, opened by the first running call and closed 
+        when the last one returns, so asyncio.run(q.batch_quotes(...)) leaves nothing open. 
+        Use the instance as an async context manager (async with Questrade(token) as q: ...) 
+        to keep one session, and its connections, across several calls
     """
     
     
-    def __init__(self, client_token):
+    def __init__(self, client_token, http2=False):
         
         self.client_token = client_token
-        self.session = requests_retry_session()
+        self.session = httpx_retry_client() if http2 else requests_retry_session(shared=True)
+        self.async_session = None
+        self._async_loop = None
+        self._async_users = 0
+        self.api_server = None
+        self.token_expiry = None
+        self._token_lock = threading.Lock()
         self.headers = None
         self.accounts = None
+        # symbol ids never change, keep them for the life of the instance
+        self._symbol_cache = {}
         
         self.get_access_token()
         self.get_accounts()
@@ -35,14 +85,15 @@ class Questrade:
 
         """
         
-        serv_url = 'https://login.questrade.com/oauth2/token?grant_type=refresh_token&refresh_token='
-        resp = self.session.get(serv_url + self.client_token)
+        resp = self.session.get(_token_url(self.client_token))
 
         if resp.text == 'Bad Request':
             raise ValueError('Invalid client token')
 
         else:
-            self.access_token = resp.json()
+            self.access_token = parse_json(resp)
+            self.api_server = self.access_token['api_server'].rstrip('/') + '/'
+            self.token_expiry = time.monotonic() + self.access_token['expires_in']
         
         self.headers = {
             "Authorization": self.access_token["token_type"]
@@ -66,15 +117,16 @@ class Questrade:
 
         """
         
-        serv_url = 'https://login.questrade.com/oauth2/token?grant_type=refresh_token&refresh_token='
         old_access_token = self.access_token
-        resp = self.session.get(serv_url + old_access_token['refresh_token'])
+        resp = self.session.get(_token_url(old_access_token['refresh_token']))
 
         if resp.text == 'Bad Request':
             raise ValueError('Invalid client token')
 
         else:
-            self.access_token = resp.json()
+            self.access_token = parse_json(resp)
+            self.api_server = self.access_token['api_server'].rstrip('/') + '/'
+            self.token_expiry = time.monotonic() + self.access_token['expires_in']
         
         self.headers = {
             "Authorization": self.access_token["token_type"]
@@ -104,19 +156,14 @@ class Questrade:
         
         acc_endpoint = 'accounts'
 
-        resp = self.session.get(
-            os.path.join(
-                self.access_token['api_server'],
-                api_version, 
-                acc_endpoint
-            )
-        ).json()
+        resp = parse_json(self._get(api_version, acc_endpoint))
         
         self.accounts = resp
 
         return self.accounts
 
     
+    @cached(endpoint='candles', ttl=_candles_ttl)
     def get_candles(self, symbol_id, start_time, end_time, time_interval, api_version='v1/'):
         """
             Retrieves candles of a specific symbol_id, for a specific interval 
@@ -134,6 +181,8 @@ class Questrade:
                 https://www.questrade.com/api/documentation/rest-operations/enumerations/enumerations#historical-data-granularity
             api_version: str, default = 'v1/'
                 the api version to be used
+            bypass_cache: bool, default = False
+                if True, ignore the on-disk cache and request the candles again
 
             Returns
             -------
@@ -141,21 +190,70 @@ class Questrade:
                 a dictionary containing the different candles retrieved
         """
 
-        candle_endpoint = 'markets/candles'
-        
-        start_t = start_time + 'T00:00:00-05:00'
-        end_t = end_time + 'T00:00:00-05:00'
+        resp = self._get(api_version, *self._candles_request(symbol_id, start_time, end_time, time_interval))
+
+        # error bodies (rate limit, bad request) must not end up in the on-disk cache
+        resp.raise_for_status()
+
+        return parse_json(resp)
+    
+    
+    def get_candles_as_df(self, symbol_id, start_time, end_time, time_interval, api_version='v1/'):
+        """
+            Retrieves candles of a specific symbol_id as a dataframe, parsing the response as it streams in
+
+            The candles go straight into column lists, the full list of candle dictionaries 
+            is never built. A response cached by get_candles is used when fresh; streamed responses 
+            are not written to the cache. Falls back to make_candles_df(get_candles()) when ijson 
+            is not installed or when the session is an httpx client
+
+            Parameters
+            ----------
+            symbol_id: str(int)
+                a string representing the id integer of the stock (ex. '8049')
+            start_time: str(date)
+                beginning of interval in 'yyyy-mm-dd' (ex. '2020-03-24')
+            end_time: str(date)
+                end of interval in 'yyyy-mm-dd' (ex. '2020-03-24')
+            time_interval: str
+                interval step as defined in get_candles (ex. OneMinute, OneHour)
+            api_version: str, default = 'v1/'
+                the api version to be used
+
+            Returns
+            -------
+            pandas DataFrame
+                where each row represents a candle, as returned by make_candles_df
+        """
+
+        if ijson is None or not isinstance(self.session, requests.Session):
+            candles = self.get_candles(symbol_id, start_time, end_time, time_interval, api_version)
+            return make_candles_df(candles['candles'])
+
+        hit, candles = Questrade.get_candles.cache_lookup(
+            self, symbol_id, start_time, end_time, time_interval, api_version
+        )
+        if hit:
+            return make_candles_df(candles['candles'])
 
-        candles = self.session.get(
-            os.path.join(
-                self.access_token['api_server'], 
-                api_version, 
-                candle_endpoint
-            ) 
-            + f'/{symbol_id}?startTime={start_t}&endTime={end_t}&interval={time_interval}'
-        ).json()
+        columns = {k: [] for k in CANDLE_COLUMNS}
 
-        return candles
+        with self._get(
+            api_version,
+            *self._candles_request(symbol_id, start_time, end_time, time_interval),
+            stream=True
+        ) as resp:
+            # an error body has no candles and would otherwise parse into an empty dataframe
+            resp.raise_for_status()
+
+            # the raw stream is still gzip encoded unless asked otherwise
+            resp.raw.decode_content = True
+
+            for candle in ijson.items(resp.raw, 'candles.item', use_float=True):
+                for k, values in columns.items():
+                    values.append(candle[k])
+
+        return make_candles_df(columns)
     
     
     def get_quote(self, symbol_id, api_version='v1/'):
@@ -175,21 +273,40 @@ class Questrade:
                 a dictionary containing the stock quote information
         """
         
-        quotes_endpoint = 'markets/quotes'
-
-        quote = self.session.get(
-            os.path.join(
-                self.access_token['api_server'], 
-                api_version, 
-                quotes_endpoint
-            )
-            + f'/{symbol_id}'
-        ).json()
+        quote = parse_json(self._get(api_version, f'markets/quotes/{symbol_id}'))
 
         return quote
     
     
-    def get_symbol_id(self, ticker, api_version='v1/'):
+    def get_quote_batch(self, symbol_ids, api_version='v1/', max_workers=8):
+        """
+            Retrieves stock quotes for several symbols using a pool of threads
+
+            Parameters
+            ----------
+            symbol_ids: list(str(int))
+                the ids of the stocks (ex. ['8049', '9292'])
+            api_version: str, default = 'v1/'
+                the api version to be used
+            max_workers: int, default = 8
+                number of threads used to send the requests
+
+            Returns
+            -------
+            dict
+                a dictionary mapping each symbol_id to its stock quote information
+        """
+
+        with ThreadPoolExecutor(max_workers) as ex:
+            responses = list(ex.map(
+                lambda symbol_id: self._get(api_version, f'markets/quotes/{symbol_id}'),
+                symbol_ids
+            ))
+
+        return {s: parse_json(r) for s, r in zip(symbol_ids, responses)}
+    
+    
+    def get_symbol_id(self, ticker, api_version='v1/', bypass_cache=False):
         """
             Retrieves symbol ID of a specific ticker
 
@@ -199,6 +316,8 @@ class Questrade:
                 well known stock ticker (ex. 'AAPL')
             api_version: str, default = 'v1/'
                 the api version to be used
+            bypass_cache: bool, default = False
+                if True, ignore the in-memory and on-disk caches and search the symbol again
 
             Returns
             -------
@@ -206,22 +325,279 @@ class Questrade:
                 a string representing the id integer of the stock (ex. '8049')
         """
         
-        symbol_search_endpoint = 'symbols/search'
+        if not bypass_cache and ticker in self._symbol_cache:
+            return self._symbol_cache[ticker]
+        
+        symbol_id = self._search_symbol_id(ticker, api_version, bypass_cache=bypass_cache)
+        self._symbol_cache[ticker] = symbol_id
+
+        return symbol_id
+    
+    
+    def prefetch_symbols(self, tickers, api_version='v1/', max_workers=8):
+        """
+            Retrieves the symbol IDs of several tickers using a pool of threads, filling the cache 
+            used by get_symbol_id
+
+            Parameters
+            ----------
+            tickers: list(str)
+                well known stock tickers (ex. ['AAPL', 'MSFT'])
+            api_version: str, default = 'v1/'
+                the api version to be used
+            max_workers: int, default = 8
+                number of threads used to send the requests
+
+            Returns
+            -------
+            dict
+                a dictionary mapping each ticker to its symbol_id
+        """
+
+        with ThreadPoolExecutor(max_workers) as ex:
+            symbol_ids = list(ex.map(lambda t: self.get_symbol_id(t, api_version), tickers))
+
+        return dict(zip(tickers, symbol_ids))
+
+
+    async def aget_candles(self, symbol_id, start_time, end_time, time_interval, api_version='v1/'):
+        """
+            Async version of get_candles, sharing the same parameters and return value.
+            Raises aiohttp.ClientResponseError on an error status
+        """
+
+        return await self._aget(
+            api_version, *self._candles_request(symbol_id, start_time, end_time, time_interval)
+        )
+
+
+    async def aget_quote(self, symbol_id, api_version='v1/'):
+        """
+            Async version of get_quote, sharing the same parameters and return value.
+            Raises aiohttp.ClientResponseError on an error status
+        """
+
+        return await self._aget(api_version, f'markets/quotes/{symbol_id}')
+
+
+    async def aget_symbol_id(self, ticker, api_version='v1/'):
+        """
+            Async version of get_symbol_id, sharing the same parameters and return value
+        """
+
+        if ticker in self._symbol_cache:
+            return self._symbol_cache[ticker]
+
+        resp = await self._aget(api_version, 'symbols/search', {'prefix': ticker})
+        self._symbol_cache[ticker] = self._match_symbol_id(resp, ticker)
+
+        return self._symbol_cache[ticker]
+
+
+    async def batch_candles(self, specs):
+        """
+            Retrieves candles for several symbols concurrently
+
+            Parameters
+            ----------
+            specs: list(dict)
+                each dict holds the keyword arguments of get_candles
+                (ex. {'symbol_id': '8049', 'start_time': '2020-03-24', 'end_time': '2020-03-25', 'time_interval': 'OneHour'})
+
+            Returns
+            -------
+            list(dict)
+                the candles retrieved for each spec, in the same order
+        """
+
+        async with self._async_session_scope():
+            return await asyncio.gather(*[self.aget_candles(**spec) for spec in specs])
+
+
+    async def batch_quotes(self, symbol_ids, api_version='v1/'):
+        """
+            Retrieves stock quotes for several symbols concurrently
+
+            Parameters
+            ----------
+            symbol_ids: list(str(int))
+                the ids of the stocks (ex. ['8049', '9292'])
+            api_version: str, default = 'v1/'
+                the api version to be used
+
+            Returns
+            -------
+            list(dict)
+                the quote retrieved for each symbol_id, in the same order
+        """
+
+        async with self._async_session_scope():
+            return await asyncio.gather(
+                *[self.aget_quote(symbol_id, api_version) for symbol_id in symbol_ids]
+            )
+
+
+    async def aclose(self):
+        """
+            Closes the aiohttp session used by the async methods, if one was opened
+        """
+
+        if self.async_session is not None:
+            await self.async_session.close()
+            self.async_session = None
+            self._async_loop = None
+
+
+    async def __aenter__(self):
+
+        await self._ensure_async_session()
+        self._async_users += 1
+
+        return self
+
+
+    async def __aexit__(self, exc_type, exc, tb):
+
+        await self._release_async_session()
+
+
+    async def _ensure_async_session(self):
+        
+        if aiohttp is None:
+            raise ImportError('aiohttp is required for the async Questrade methods')
+
+        loop = asyncio.get_running_loop()
+
+        # an aiohttp session only works on the loop that created it. Sessions are closed by 
+        # _release_async_session, a session of another loop is only left if that loop was torn down mid call
+        if self.async_session is None or self.async_session.closed or self._async_loop is not loop:
+            self.async_session = aiohttp.ClientSession(
+                headers=self.headers,
+                connector=aiohttp.TCPConnector(limit=32)
+            )
+            self._async_loop = loop
+            self._async_users = 0
 
-        resp = self.session.get(
-        os.path.join(
-            self.access_token['api_server'], 
-            api_version, 
-            symbol_search_endpoint
+        return self.async_session
+
+
+    @contextlib.asynccontextmanager
+    async def _async_session_scope(self):
+
+        session = await self._ensure_async_session()
+        self._async_users += 1
+
+        try:
+            yield session
+        finally:
+            await self._release_async_session()
+
+
+    async def _release_async_session(self):
+
+        # close the session on its own loop once no call or async with block uses it
+        self._async_users -= 1
+
+        if self._async_users <= 0:
+            self._async_users = 0
+            await self.aclose()
+
+
+    async def _aget(self, api_version, endpoint, params=None):
+
+        # the token refresh is a blocking request, keep it off the event loop
+        if self._token_expiring():
+            await asyncio.to_thread(self._refresh_if_current, self.access_token)
+
+        access_token = self.access_token
+
+        async with self._async_session_scope() as session:
+            # headers are passed per request so a refreshed token is always used
+            async with session.get(self._url(api_version, endpoint, params), headers=self.headers) as resp:
+                if resp.status != 401:
+                    # same as the sync getters: error bodies are raised, never returned as data
+                    resp.raise_for_status()
+                    return parse_json(await resp.read())
+
+            await asyncio.to_thread(self._refresh_if_current, access_token)
+
+            async with session.get(self._url(api_version, endpoint, params), headers=self.headers) as resp:
+                resp.raise_for_status()
+                return parse_json(await resp.read())
+
+
+    def _get(self, api_version, endpoint, params=None, **kwargs):
+
+        if self._token_expiring():
+            self._refresh_if_current(self.access_token)
+
+        access_token = self.access_token
+        resp = self.session.get(self._url(api_version, endpoint, params), **kwargs)
+
+        # the token can still be revoked or expire early, refresh once and retry. 
+        # The new token can come with a different api_server, so the url is built again
+        if resp.status_code == 401:
+            resp.close()
+            self._refresh_if_current(access_token)
+            resp = self.session.get(self._url(api_version, endpoint, params), **kwargs)
+
+        return resp
+
+
+    def _token_expiring(self):
+
+        # refresh slightly before expiry so requests never hit a 401 in the normal case
+        return time.monotonic() >= self.token_expiry - 30
+
+
+    def _refresh_if_current(self, access_token):
+
+        # refresh tokens are single use: when concurrent requests fail with the same token, 
+        # only the first one refreshes it, the others reuse the new one
+        with self._token_lock:
+            if self.access_token is access_token:
+                self.refresh_access_token()
+
+
+    @cached(endpoint='symbol_id', ttl=86400 * 30)
+    def _search_symbol_id(self, ticker, api_version='v1/'):
+
+        resp = self._get(api_version, 'symbols/search', {'prefix': ticker})
+        resp.raise_for_status()
+
+        return self._match_symbol_id(parse_json(resp), ticker)
+
+
+    def _url(self, api_version, endpoint, params=None):
+
+        # api_server is normalized to end with '/' when the access token is set, 
+        # api_version is accepted with or without its trailing '/' as os.path.join did
+        url = self.api_server + api_version.rstrip('/') + '/' + endpoint
+
+        if params:
+            url += '?' + urlencode(params)
+
+        return url
+
+
+    @staticmethod
+    def _candles_request(symbol_id, start_time, end_time, time_interval):
+
+        return (
+            f'markets/candles/{symbol_id}',
+            {
+                'startTime': start_time + 'T00:00:00-05:00',
+                'endTime': end_time + 'T00:00:00-05:00',
+                'interval': time_interval
+            }
         )
-        + f'?prefix={ticker}'
-        ).json()
+
+
+    @staticmethod
+    def _match_symbol_id(resp, ticker):
 
         # search can return more than 1 symbol. We want to return an exact match
         if resp['symbols'][0]['symbol'] == ticker:
-            symbol_id = str(resp['symbols'][0]['symbolId'])
+            return str(resp['symbols'][0]['symbolId'])
 
-        else:
-            raise ValueError('No exact match was found for the requested ticker')
-
-        return symbol_id
+        raise ValueError('No exact match was found for the requested ticker')
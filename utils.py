@@ -1,5 +1,13 @@
+from collections import deque
 from datetime import date
+from functools import lru_cache, wraps
 import requests
+import hashlib
+import inspect
+import tempfile
+import threading
+import json
+import time
 import os
 
 from pandas.tseries.holiday import USFederalHolidayCalendar
@@ -8,8 +16,22 @@ from dateutil.relativedelta import relativedelta
 import pandas as pd
 import numpy as np
 
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 
-def requests_retry_session(retries=3, backoff_factor=0.3, status_forcelist=(500, 502, 504)):
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+CANDLE_COLUMNS = ['start', 'end', 'open', 'close', 'low', 'high', 'volume', 'VWAP']
+
+
+def requests_retry_session(retries=3, backoff_factor=0.3, status_forcelist=(500, 502, 504), pool_maxsize=32, shared=False):
     """
         Enables retires for requests
         
@@ -21,14 +43,85 @@ def requests_retry_session(retries=3, backoff_factor=0.3, status_forcelist=(500,
             controls the time before making a new request after the first one fails
         status_forcelist: tuple(int)
             the status codes for which a retry is launched
+        pool_maxsize: int
+            number of connections kept alive per host
+        shared: bool
+            if True, mount the process-wide adapter returned by shared_retry_adapter() instead of
+            a new one, so every session created this way reuses the same connection pool.
+            The retry and pool parameters above are then ignored
         
         Returns
         -------
         session: requests.session object
-            session with retry parameters   
+            session with retry parameters, asking for gzip/deflate encoded responses.
+            the compressed body is decoded transparently (response.content, response.json())
     """
     
     session = requests.Session()
+    session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+    
+    if shared:
+        adapter = shared_retry_adapter()
+    else:
+        adapter = _retry_adapter(retries, backoff_factor, status_forcelist, pool_maxsize)
+    
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    
+    return session
+
+
+def httpx_retry_client(retries=3, max_connections=20):
+    """
+        Builds an HTTP/2 client, an alternative to requests_retry_session for concurrent calls
+        
+        Requests sent from several threads to the same host are multiplexed over one 
+        connection instead of waiting for a free socket. Requires httpx[http2]
+        
+        Parameters
+        ----------
+        retries: int
+            number of attempts on connection errors (httpx does not retry on status codes)
+        max_connections: int
+            maximum number of open connections
+        
+        Returns
+        -------
+        client: httpx.Client object
+            client exposing the same get/headers interface used on requests sessions
+    """
+    
+    if httpx is None:
+        raise ImportError('httpx is required for httpx_retry_client, install it with httpx[http2]')
+    
+    return httpx.Client(
+        transport=httpx.HTTPTransport(
+            http2=True,
+            retries=retries,
+            limits=httpx.Limits(max_connections=max_connections)
+        )
+    )
+
+
+@lru_cache(maxsize=1)
+def shared_retry_adapter():
+    """
+        Builds, once per process, the adapter shared by the AlphaVantage and Questrade sessions
+        
+        Headers (ex. the Questrade Authorization) stay on each session, only the 
+        keep-alive connections and TLS sessions are shared
+        
+        Returns
+        -------
+        requests.adapters.HTTPAdapter
+            adapter with the default retry parameters of requests_retry_session()
+    """
+    
+    return _retry_adapter(3, 0.3, (500, 502, 504), 32)
+
+
+def _retry_adapter(retries, backoff_factor, status_forcelist, pool_maxsize):
+    
     retry = requests.packages.urllib3.util.retry.Retry(
         total=retries,
         read=retries,
@@ -37,11 +130,228 @@ def requests_retry_session(retries=3, backoff_factor=0.3, status_forcelist=(500,
         status_forcelist=status_forcelist
     )
     
-    adapter = requests.adapters.HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
+    return requests.adapters.HTTPAdapter(
+        max_retries=retry,
+        pool_connections=pool_maxsize,
+        pool_maxsize=pool_maxsize
+    )
+
+
+def parse_json(resp):
+    """
+        Parses a JSON response body, using orjson when it is installed
+        
+        Parameters
+        ----------
+        resp: requests.Response or bytes
+            the response (or raw body) to parse
+        
+        Returns
+        -------
+        dict or list
+            the same structure response.json() would return
+    """
     
-    return session
+    if isinstance(resp, (bytes, bytearray, str)):
+        return _json_loads(resp)
+    
+    return _json_loads(resp.content)
+
+
+class FileCache:
+    """
+        Stores JSON responses on disk, one file per request, under cache_dir/<endpoint>/<md5>.json
+
+        Parameters
+        -------
+        cache_dir: str, default = '.cache'
+            folder where the cached responses are written
+    """
+    
+    def __init__(self, cache_dir='.cache'):
+        
+        self.cache_dir = cache_dir
+        
+    @staticmethod
+    def key(params):
+        """
+            Builds the cache key of a request from its parameters
+
+            Parameters
+            ----------
+            params: dict
+                the parameters identifying the request
+
+            Returns
+            -------
+            str
+                md5 hex digest of the sorted parameters
+        """
+        
+        return hashlib.md5(json.dumps(sorted(params.items()), default=str).encode()).hexdigest()
+    
+    def get(self, endpoint, key, ttl):
+        """
+            Reads a cached response
+
+            Parameters
+            ----------
+            endpoint: str
+                the name of the cached endpoint (ex. 'sma')
+            key: str
+                the key returned by FileCache.key()
+            ttl: float
+                maximum age of the cached response, in seconds
+
+            Returns
+            -------
+            tuple(bool, object)
+                (True, data) on a fresh hit, (False, None) on a miss or expired entry
+        """
+        
+        try:
+            with open(self._path(endpoint, key), 'rb') as f:
+                entry = parse_json(f.read())
+        except (OSError, ValueError):
+            return False, None
+        
+        if time.time() - entry['ts'] > ttl:
+            return False, None
+        
+        return True, entry['data']
+    
+    def set(self, endpoint, key, data):
+        """
+            Writes a response to the cache
+
+            Parameters
+            ----------
+            endpoint: str
+                the name of the cached endpoint (ex. 'sma')
+            key: str
+                the key returned by FileCache.key()
+            data: dict or list or str
+                the JSON serializable response to store
+        """
+        
+        path = self._path(endpoint, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        
+        # write to a unique temp file then rename, so concurrent writers (threads or processes) 
+        # never share a temp file and readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'ts': time.time(), 'data': data}, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        
+    def _path(self, endpoint, key):
+        
+        return os.path.join(self.cache_dir, endpoint, f'{key}.json')
+
+
+class RateLimiter:
+    """
+        Blocks callers so that at most `calls` requests start in any `period` seconds window.
+        Thread safe, a single instance can throttle a whole thread pool
+
+        Parameters
+        -------
+        calls: int
+            number of requests allowed per period
+        period: float, default = 60
+            length of the window, in seconds
+    """
+    
+    def __init__(self, calls, period=60):
+        
+        self.calls = calls
+        self.period = period
+        self._starts = deque(maxlen=calls)
+        self._lock = threading.Lock()
+        
+    def wait(self):
+        """
+            Waits until one more request can be sent, then records it
+        """
+        
+        with self._lock:
+            if len(self._starts) == self.calls:
+                time.sleep(max(0, self._starts[0] + self.period - time.monotonic()))
+            
+            self._starts.append(time.monotonic())
+
+
+def cached(endpoint, ttl, cache=None):
+    """
+        Decorator caching the return value of a request method in a FileCache
+        
+        The decorated function accepts an extra bypass_cache=False keyword argument, which forces 
+        a new request (the fresh result is still written to the cache). Nothing is stored when the 
+        function raises, so it should raise on error responses rather than return them.
+        func.cache_lookup(*args, **kwargs) returns the (hit, data) a call would find in the cache 
+        (self included for methods), without calling the function
+        
+        Parameters
+        ----------
+        endpoint: str
+            the name of the cached endpoint, used as sub folder of the cache (ex. 'sma')
+        ttl: float or callable
+            maximum age of a cached response in seconds, or a function receiving the call 
+            parameters as a dict and returning that age
+        cache: FileCache, default = None
+            the cache to use. A FileCache in '.cache' if None
+        
+        Returns
+        -------
+        function
+            the decorator
+    """
+    
+    cache = cache or FileCache()
+    
+    def decorator(func):
+        
+        signature = inspect.signature(func)
+        
+        def request_key(args, kwargs):
+            
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            params = {k: v for k, v in bound.arguments.items() if k != 'self'}
+            
+            return params, cache.key(params)
+        
+        def cache_lookup(*args, **kwargs):
+            
+            params, key = request_key(args, kwargs)
+            
+            return cache.get(endpoint, key, ttl(params) if callable(ttl) else ttl)
+        
+        @wraps(func)
+        def wrapper(*args, bypass_cache=False, **kwargs):
+            
+            params, key = request_key(args, kwargs)
+            
+            if not bypass_cache:
+                hit, data = cache.get(endpoint, key, ttl(params) if callable(ttl) else ttl)
+                if hit:
+                    return data
+            
+            data = func(*args, **kwargs)
+            cache.set(endpoint, key, data)
+            
+            return data
+        
+        # lets callers with their own request path (ex. streaming) reuse a cached response
+        wrapper.cache_lookup = cache_lookup
+        
+        return wrapper
+    
+    return decorator
 
 
 def is_trading_day():
@@ -54,9 +364,20 @@ def is_trading_day():
             True if today is a trading day, False if not   
     """
     
-    us_business_day = CustomBusinessDay(calendar=USFederalHolidayCalendar())
+    return _is_trading_date(date.today())
+
+
+@lru_cache(maxsize=None)
+def _is_trading_date(day):
     
-    return date.today() == date.today() + 0 * us_business_day
+    return bool(_us_business_day().is_on_offset(pd.Timestamp(day)))
+
+
+@lru_cache(maxsize=1)
+def _us_business_day():
+    
+    # building the holiday calendar is expensive: do it once per process, on first use rather than on import
+    return CustomBusinessDay(calendar=USFederalHolidayCalendar())
 
 
 def get_trading_date_range():
@@ -81,9 +402,9 @@ def get_pivots(low_list, high_list, n_periods):
 
         Parameters
         ----------
-        low_list: list(float)
+        low_list: list(float) or numpy array or pandas Series
             a list of floats with the lows of each period
-        high_list: list(float)
+        high_list: list(float) or numpy array or pandas Series
             a list of floats with the highs of each period
 
         Returns
@@ -92,11 +413,26 @@ def get_pivots(low_list, high_list, n_periods):
              a touple with 2 touples, containing lowest and highes levels with number of periods lagging
     """
     
-    tmp_low = min(low_list[:n_periods])
-    tmp_low_days = low_list[:n_periods].index(tmp_low)
+    lows = low_list[:n_periods]
+    highs = high_list[:n_periods]
+    
+    # for lists min() + index() is cheaper than building arrays; arrays and Series are sliced 
+    # as views, and argmin/argmax return the first occurrence, same as list.index()
+    if isinstance(lows, list):
+        tmp_low = min(lows)
+        tmp_low_days = lows.index(tmp_low)
+    else:
+        lows = np.asarray(lows)
+        tmp_low_days = int(lows.argmin())
+        tmp_low = lows[tmp_low_days]
     
-    tmp_high = max(high_list[:n_periods])
-    tmp_high_days = high_list[:n_periods].index(tmp_high)
+    if isinstance(highs, list):
+        tmp_high = max(highs)
+        tmp_high_days = highs.index(tmp_high)
+    else:
+        highs = np.asarray(highs)
+        tmp_high_days = int(highs.argmax())
+        tmp_high = highs[tmp_high_days]
     
     return((tmp_low, tmp_low_days), (tmp_high, tmp_high_days))
 
@@ -107,7 +443,7 @@ def get_average_volume(volume_list, n_periods):
 
         Parameters
         ----------
-        volume_list: list(float)
+        volume_list: list(float) or numpy array or pandas Series
             a list of floats with the volume for each period
 
         Returns
@@ -116,13 +452,26 @@ def get_average_volume(volume_list, n_periods):
              the average volume for the given interval
     """
     
-    return np.mean(volume_list[:n_periods])
+    volumes = volume_list[:n_periods]
+    
+    # for short lists building an array costs more than the sum; arrays and Series are sliced as views
+    if not isinstance(volume_list, list):
+        return np.asarray(volumes).mean()
+    
+    if len(volumes) == 0:
+        return np.nan
+    
+    return sum(volumes) / len(volumes)
 
 
-def get_sma_col(df, col_name, window):
+def get_sma_col(df, col_name, window, inplace=False):
     """
         adds moving average column(s) to a dataframe
 
+        The averages are computed from a running sum, whose rounding error grows with the length
+        of the series: on a million rows around 1e4 they can differ from rolling().mean() by ~1e-6.
+        Windows containing NaN or inf give NaN
+
         Parameters
         ----------
         df: pandas dataframe
@@ -130,7 +479,9 @@ def get_sma_col(df, col_name, window):
         col_name: str
             the name of a column contained in the df 
         window: int or list(int)
-            the simple moving averages to be calculated (ex. 7, 14)
+            the simple moving averages to be calculated, each >= 1 (ex. 7, 14)
+        inplace: bool, default = False
+            if True, add the columns to df itself instead of a shallow copy sharing its data
 
         Returns
         -------
@@ -141,42 +492,64 @@ def get_sma_col(df, col_name, window):
     if isinstance(window, int):
         window = [window]
     
-    new_df = df.copy()
+    if any(i < 1 for i in window):
+        raise ValueError(f'window must be a positive integer, got {window}')
+    
+    # only new columns are added, so a shallow copy is enough to leave df untouched
+    new_df = df if inplace else df.copy(deep=False)
+    
+    # a single cumulative sum serves every window: sum(x[j-i+1..j]) = cs[j+1] - cs[j+1-i]
+    # non finite values (NaN, inf) are left out of the sum and counted separately, so only the windows 
+    # containing one give NaN instead of every later row
+    vals = new_df[col_name].to_numpy(dtype=float)
+    missing = ~np.isfinite(vals)
+    cs = np.concatenate(([0.0], np.cumsum(np.where(missing, 0.0, vals))))
+    cs_missing = np.concatenate(([0], np.cumsum(missing)))
     
     for i in window:
-        new_df[f'{col_name}_SMA_{str(i)}'] = new_df[col_name].rolling(window=i).mean()
+        sma = np.full(len(vals), np.nan)
+        sma[i - 1:] = (cs[i:] - cs[:-i]) / i
+        sma[i - 1:][cs_missing[i:] - cs_missing[:-i] > 0] = np.nan
+        new_df[f'{col_name}_SMA_{str(i)}'] = sma
         
     return new_df
 
 
-def make_candles_df(candles_list):
+def make_candles_df(candles_list, python_dates=False):
     """
         Retrieves candle values from a list containing the candles in dictionary format
 
         Parameters
         ----------
-        candles_list: list(dict)
-            a list with dictionaries, each containing the candle of a specific period
+        candles_list: list(dict) or dict(list)
+            a list with dictionaries, each containing the candle of a specific period,
+            or a dictionary with one list per candle field
+        python_dates: bool, default = False
+            if True, also add date_obj and time_obj columns holding datetime.date and datetime.time objects
 
         Returns
         -------
         pandas DataFrame
-            where each row represents a candle in the given timeframe 
+            where each row represents a candle in the given timeframe, with the exchange local 
+            day in date (datetime64, midnight) and the time since midnight in time_of_day_ns (int64)
     """
     
-    values_dict = {
-    'start': [], 'end': [], 'open': [], 'close': [], 'low': [], 'high': [], 'volume': [], 'VWAP': []
-    }
+    df = pd.DataFrame(candles_list, columns=CANDLE_COLUMNS)
     
-    for i in values_dict.keys():
-        for j in range(len(candles_list)):
-
-            values_dict[i].append(candles_list[j][i])
-
-    values_dict['date'] = [pd.to_datetime(tmp).date() for tmp in values_dict['end']]
-    values_dict['time'] = [pd.to_datetime(tmp).time() for tmp in values_dict['end']]
+    # parse all timestamps in one pass; utc=True handles the EST/EDT offset change, 
+    # converting back gives the exchange local wall time
+    end = pd.to_datetime(df['end'], utc=True).dt.tz_convert('America/New_York').dt.tz_localize(None)
+    
+    # stay in datetime64, Python date/time objects cost one allocation per row
+    day = end.dt.normalize()
+    df['date'] = day
+    df['time_of_day_ns'] = (end - day).astype('timedelta64[ns]').astype('int64')
+    
+    if python_dates:
+        df['date_obj'] = end.dt.date
+        df['time_obj'] = end.dt.time
             
-    return pd.DataFrame(values_dict)
+    return df
 
 
 def build_sma_df(sma_dict, sma_days, ticker, gapping_date):
@@ -201,23 +574,25 @@ def build_sma_df(sma_dict, sma_days, ticker, gapping_date):
     """
 
     dates_list = list(sma_dict.keys())
-    ticker_list = [ticker for t in range(len(dates_list))]
-    gapping_date_list = [gapping_date for g in range(len(dates_list))]
     sma_vals = [float(tmp['SMA']) for tmp in sma_dict.values()]
+    index = pd.RangeIndex(len(dates_list))
+
+    # dates are unique dict keys: drop the gapping date from the lists before building the frame 
+    # rather than filtering it afterwards, keeping the index the filtered frame used to have
+    if gapping_date in sma_dict:
+        i = dates_list.index(gapping_date)
+        del dates_list[i], sma_vals[i]
+        index = index.delete(i)
 
+    # ticker and gapping_date are scalars, broadcast by pandas
     df = pd.DataFrame(
-        list(zip(
-            ticker_list, 
-            dates_list, 
-            gapping_date_list, 
-            sma_vals)),
-        columns = [
-            'ticker', 
-            'date', 
-            'gapping_date', 
-            f'SMA_{sma_days}'])
-
-    df = df[df['date'] != gapping_date]
+        {
+            'ticker': ticker, 
+            'date': dates_list, 
+            'gapping_date': gapping_date, 
+            f'SMA_{sma_days}': sma_vals
+        },
+        index=index
+    )
 
     return df
-